@@ -5,20 +5,83 @@
 import os
 import sys
 import shutil
+import contextlib
 import logging
 import tempfile
 import argparse
+import unittest
 
-from nmigen             import Elaboratable
-from nmigen._unused     import MustUse
-
-from .gateware.platform import get_appropriate_platform
+from nmigen._unused import MustUse
 
 # Log formatting strings.
 LOG_FORMAT_COLOR = "\u001b[37;1m%(levelname)-8s| \u001b[0m\u001b[1m%(module)-12s|\u001b[0m %(message)s"
 LOG_FORMAT_PLAIN = "%(levelname)-8s:n%(module)-12s>%(message)s"
 
 
+def _copy_build_products(products_dir, build_dir):
+    """ Copies a set of build products into the given build directory, replacing any existing files. """
+
+    os.makedirs(build_dir, exist_ok=True)
+
+    for entry in os.listdir(products_dir):
+        source      = os.path.join(products_dir, entry)
+        destination = os.path.join(build_dir, entry)
+
+        if os.path.isdir(source):
+            shutil.rmtree(destination, ignore_errors=True)
+            shutil.copytree(source, destination)
+        else:
+            shutil.copy2(source, destination)
+
+
+def _build_with_cache(platform, fragment, build_dir, keep_files=False):
+    """ Builds the given fragment; re-using the results of an identical previous build, if one exists.
+
+    Builds are cached in ``$XDG_CACHE_HOME/luna`` (or ``~/.cache/luna``), keyed by a digest of
+    the build plan -- which covers every file handed to the toolchain, and the toolchain script itself.
+
+    If ``keep_files`` is set, the build products are also copied into ``build_dir``; whether or not they
+    came from our cache.
+
+    Returns the path to a directory containing the relevant build products.
+    """
+
+    # Generate our build plan, which uniquely identifies the design we're building. We generate this
+    # via `build()`, so we still get nMigen's checks for a missing toolchain.
+    plan = platform.build(fragment, "top", do_build=False)
+
+    cache_key  = plan.digest(size=32).hex()
+    cache_root = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "luna")
+    cache_dir  = os.path.join(cache_root, cache_key)
+
+    if os.path.isdir(cache_dir):
+        logging.info(f"Using cached build products from {cache_dir}.")
+
+    # If we don't have a cached build, build our design into an empty staging directory, so our cache only
+    # ever receives this build's products. We then move it into place, so an interrupted build never leaves
+    # a partial build in our cache.
+    else:
+        staging_dir = os.path.join(cache_root, f".{cache_key}.{os.getpid()}")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+        try:
+            plan.execute_local(staging_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(staging_dir, cache_dir)
+        except OSError:
+            # Another build populated our cache first; which is fine, as its products are identical.
+            shutil.rmtree(staging_dir)
+
+    if keep_files:
+        _copy_build_products(cache_dir, build_dir)
+
+    return cache_dir
+
+
 def top_level_cli(fragment, *pos_args, cli_soc=None, **kwargs):
     """ Runs a default CLI that assists in building and running gateware.
 
@@ -67,6 +130,24 @@ def top_level_cli(fragment, *pos_args, cli_soc=None, **kwargs):
 
     args = parser.parse_args()
 
+    # The SoC-artifact options don't need any of our build setup; so handle them before
+    # we configure logging or instantiate our fragment.
+
+    # If we've been asked to generate a C header, generate -only- that.
+    if cli_soc and args.generate_c_header:
+        cli_soc.generate_c_header()
+        sys.exit(0)
+
+    # If we've been asked to generate linker region info, generate -only- that.
+    if cli_soc and args.generate_ld_script:
+        cli_soc.generate_ld_script()
+        sys.exit(0)
+
+    # If we've been asked for our firmware's load address, print -only- that.
+    if cli_soc and args.get_fw_address:
+        print(f"0x{cli_soc.main_ram_address():08x}")
+        sys.exit(0)
+
     # Set up our logging / output.
     if sys.stdout.isatty():
         log_format = LOG_FORMAT_COLOR
@@ -90,27 +171,12 @@ def top_level_cli(fragment, *pos_args, cli_soc=None, **kwargs):
         args.erase = False
         args.upload = False
 
+    # Build the relevant files; in a temporary directory that's cleaned up once we're done,
+    # unless we've been asked to keep our build files around.
+    with contextlib.ExitStack() as stack:
+        build_dir = "build" if args.keep_files else stack.enter_context(tempfile.TemporaryDirectory())
 
-    # If we've been asked to generate a C header, generate -only- that.
-    if cli_soc and args.generate_c_header:
-        cli_soc.generate_c_header()
-        sys.exit(0)
-
-    # If we've been asked to generate linker region info, generate -only- that.
-    if cli_soc and args.generate_ld_script:
-        cli_soc.generate_ld_script()
-        sys.exit(0)
-
-
-    if cli_soc and args.get_fw_address:
-        print(f"0x{cli_soc.main_ram_address():08x}")
-        sys.exit(0)
-
-    # Build the relevant gateware, uploading if requested.
-    build_dir = "build" if args.keep_files else tempfile.mkdtemp()
-
-    # Build the relevant files.
-    try:
+        from .gateware.platform import get_appropriate_platform
         platform = get_appropriate_platform()
 
         # If we have a toolchain override, apply it to our platform.
@@ -137,10 +203,24 @@ def top_level_cli(fragment, *pos_args, cli_soc=None, **kwargs):
 
         # Now that we're actually building, re-enable Unused warnings.
         MustUse._MustUse__silence = False
-        products = platform.build(fragment,
-            do_program=args.upload,
-            build_dir=build_dir
-        )
+
+        # If we've been asked to cache our builds, re-use the products of any identical earlier build.
+        if os.getenv("LUNA_BUILD_CACHE") == "1":
+            from nmigen.build.run import LocalBuildProducts
+
+            products_dir = _build_with_cache(platform, fragment, build_dir, keep_files=args.keep_files)
+            products     = LocalBuildProducts(products_dir)
+
+            if args.upload:
+                platform.toolchain_program(products, "top")
+
+        # Otherwise, always build from scratch.
+        else:
+            products_dir = build_dir
+            products     = platform.build(fragment,
+                do_program=args.upload,
+                build_dir=build_dir
+            )
 
         logging.info(f"{'Upload' if args.upload else 'Build'} complete.")
 
@@ -150,21 +230,106 @@ def top_level_cli(fragment, *pos_args, cli_soc=None, **kwargs):
             platform.toolchain_flash(products)
             logging.info("Programming complete.")
 
-        # If we're outputting a file, write it.
+        # If we're outputting a file, copy it out of our build directory. We copy the file directly,
+        # rather than reading it via `products.get()`, to avoid holding the whole bitstream in memory.
         if args.output:
-            bitstream =  products.get("top.bit")
-            with open(args.output, "wb") as f:
-                f.write(bitstream)
+            shutil.copyfile(os.path.join(products_dir, "top.bit"), args.output)
 
         # Return the fragment we're working with, for convenience.
         if args.upload or args.flash:
             return fragment
 
-    # Clean up any directories we've created.
-    finally:
-        if not args.keep_files:
-            shutil.rmtree(build_dir)
-
     return None
 
 
+
+class BuildCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temporary_directory = tempfile.TemporaryDirectory()
+        self.root = self.temporary_directory.name
+
+        # Keep our cache inside our temporary directory.
+        self.original_cache_home = os.environ.get("XDG_CACHE_HOME")
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.root, "cache")
+
+        self.build_count_file = os.path.join(self.root, "build_count")
+
+
+    def tearDown(self):
+        if self.original_cache_home is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = self.original_cache_home
+
+        self.temporary_directory.cleanup()
+
+
+    def stub_platform(self):
+        """ Returns a stand-in platform, whose build script 'builds' a bitstream; and counts its builds. """
+        from nmigen.build.run import BuildPlan
+
+        build_count_file = self.build_count_file
+
+        class StubPlatform:
+            def build(self, fragment, name, *, do_build):
+                assert not do_build
+
+                plan = BuildPlan(script=f"build_{name}")
+                plan.add_file(f"{name}.v", fragment)
+                plan.add_file(f"build_{name}.sh", f"cp {name}.v {name}.bit\necho >> {build_count_file}\n")
+                return plan
+
+        return StubPlatform()
+
+
+    def build_count(self):
+        if not os.path.exists(self.build_count_file):
+            return 0
+
+        with open(self.build_count_file) as f:
+            return len(f.readlines())
+
+
+    def test_cache_miss_populates_cache(self):
+        products_dir = _build_with_cache(self.stub_platform(), "design", os.path.join(self.root, "build"))
+
+        self.assertEqual(self.build_count(), 1)
+        self.assertTrue(products_dir.startswith(os.path.join(self.root, "cache", "luna")))
+
+        with open(os.path.join(products_dir, "top.bit")) as f:
+            self.assertEqual(f.read(), "design")
+
+
+    def test_cache_hit_skips_build(self):
+        first  = _build_with_cache(self.stub_platform(), "design", os.path.join(self.root, "build1"))
+        second = _build_with_cache(self.stub_platform(), "design", os.path.join(self.root, "build2"))
+
+        self.assertEqual(first, second)
+        self.assertEqual(self.build_count(), 1)
+
+        # A different design shouldn't share our cache entry.
+        _build_with_cache(self.stub_platform(), "other design", os.path.join(self.root, "build3"))
+        self.assertEqual(self.build_count(), 2)
+
+
+    def test_keep_files_copies_products(self):
+        build_dir = os.path.join(self.root, "build")
+
+        # Start with a build directory that contains products from some other design...
+        os.makedirs(build_dir)
+        with open(os.path.join(build_dir, "stale.bit"), "w") as f:
+            f.write("stale")
+
+        # ... and build both with and without a cache hit.
+        for _ in range(2):
+            products_dir = _build_with_cache(self.stub_platform(), "design", build_dir, keep_files=True)
+
+            # Our build directory should always wind up with our products...
+            with open(os.path.join(build_dir, "top.bit")) as f:
+                self.assertEqual(f.read(), "design")
+
+            # ... but our cache should never pick up anything else that was in our build directory.
+            self.assertNotIn("stale.bit", os.listdir(products_dir))
+
+        self.assertEqual(self.build_count(), 1)
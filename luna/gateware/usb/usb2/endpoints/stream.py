@@ -7,12 +7,15 @@ The endpoint interfaces in this module provide endpoint interfaces suitable for
 connecting streams to USB endpoints.
 """
 
-from nmigen         import Elaboratable, Module, Signal
+import unittest
+
+from nmigen         import Elaboratable, Module, Signal, Cat
 
 from ..endpoint     import EndpointInterface
 from ...stream      import StreamInterface, USBOutStreamBoundaryDetector
 from ..transfer     import USBInTransferManager
 from ....memory     import TransactionalizedFIFO
+from ....test       import LunaUSBGatewareTestCase, usb_domain_test_case
 
 
 class USBStreamInEndpoint(Elaboratable):
@@ -20,7 +23,7 @@ class USBStreamInEndpoint(Elaboratable):
 
     This interface is suitable for a single bulk or interrupt endpoint.
 
-    This endpoint interface will automatically generate ZLPs when a stream packet would end without
+    By default, this endpoint interface will automatically generate ZLPs when a stream packet would end without
     a short data packet. If the stream's ``last`` signal is tied to zero, then a continuous stream of
     maximum-length-packets will be sent with no inserted ZLPs.
 
@@ -44,13 +47,19 @@ class USBStreamInEndpoint(Elaboratable):
     max_packet_size: int
         The maximum packet size for this endpoint. Should match the wMaxPacketSize provided in the
         USB endpoint descriptor.
+    generate_zlps: bool, optional
+        If True, ZLPs will be generated when a stream packet ends on a max-packet-size boundary; so
+        stream packet boundaries are visible to the host. If False, no ZLPs are ever generated; which is
+        appropriate for streams whose transfers are always a multiple of the maximum packet size, or whose
+        boundaries aren't significant. Defaults to True.
     """
 
 
-    def __init__(self, *, endpoint_number, max_packet_size):
+    def __init__(self, *, endpoint_number, max_packet_size, generate_zlps=True):
 
         self._endpoint_number = endpoint_number
         self._max_packet_size = max_packet_size
+        self._generate_zlps   = generate_zlps
 
         #
         # I/O port
@@ -68,8 +77,8 @@ class USBStreamInEndpoint(Elaboratable):
 
         m.d.comb += [
 
-            # Always generate ZLPs; in order to pass along when stream packets terminate.
-            tx_manager.generate_zlps    .eq(1),
+            # Generate ZLPs, if requested; in order to pass along when stream packets terminate.
+            tx_manager.generate_zlps    .eq(int(self._generate_zlps)),
 
             # We want to handle packets only that target our endpoint number.
             tx_manager.active           .eq(interface.tokenizer.endpoint == self._endpoint_number),
@@ -117,14 +126,15 @@ class USBStreamOutEndpoint(Elaboratable):
         the endpoint buffer, this endpoint will NAK (or participate in the PING protocol.)
     buffer_size: int, optional
         The total amount of data we'll keep in the buffer; typically two max-packet-sizes or more.
-        Defaults to twice the maximum packet size.
+        Defaults to four times the maximum packet size; which lets us keep accepting packets while our
+        consumer stalls briefly, rather than NAK'ing, at the cost of some additional buffer memory.
     """
 
 
     def __init__(self, *, endpoint_number, max_packet_size, buffer_size=None):
         self._endpoint_number = endpoint_number
         self._max_packet_size = max_packet_size
-        self._buffer_size = buffer_size if (buffer_size is not None) else (self._max_packet_size * 2)
+        self._buffer_size = buffer_size if (buffer_size is not None) else (self._max_packet_size * 4)
 
         #
         # I/O port
@@ -164,11 +174,11 @@ class USBStreamOutEndpoint(Elaboratable):
         ]
 
         rx       = boundary_detector.processed_stream
-        rx_first = boundary_detector.first
         rx_last  = boundary_detector.last
 
-        # Create a Rx FIFO.
-        m.submodules.fifo = fifo = TransactionalizedFIFO(width=10, depth=self._buffer_size, name="rx_fifo", domain="usb")
+        # Create a Rx FIFO. We store only our payload and `last` bit; as our `first` bit can be
+        # regenerated on the read side of the FIFO.
+        m.submodules.fifo = fifo = TransactionalizedFIFO(width=9, depth=self._buffer_size, name="rx_fifo", domain="usb")
 
         # Generate our `first` bit from the most recently transmitted bit.
         # Essentially, if the most recently valid byte was accompanied by an asserted `last`, the next byte
@@ -182,13 +192,24 @@ class USBStreamOutEndpoint(Elaboratable):
         #
 
         endpoint_number_matches  = (tokenizer.endpoint == self._endpoint_number)
-        targeting_endpoint       = endpoint_number_matches & tokenizer.is_out
+
+        # We'll register whether the current token targets our endpoint, which shortens the logic paths into our
+        # FIFO and handshake generation. This costs us a cycle of latency; but the tokenizer's outputs settle long
+        # before any data arrives, or any response is requested.
+        targeting_endpoint       = Signal()
+        m.d.usb += targeting_endpoint.eq(endpoint_number_matches & tokenizer.is_out)
 
         expected_pid_match       = (interface.rx_pid_toggle == expected_data_toggle)
-        sufficient_space         = (fifo.space_available >= self._max_packet_size)
+
+        # We'll decide whether we have room for a packet once, when its token arrives. Our FIFO's available space
+        # shrinks as we write the packet's (not yet committed) data; so re-checking it mid-packet could stop us
+        # accepting data part way through a packet -- leaving a fragment of that packet in our FIFO.
+        sufficient_space         = Signal()
+        with m.If(tokenizer.new_token):
+            m.d.usb += sufficient_space.eq(fifo.space_available >= self._max_packet_size)
 
         ping_response_requested  = endpoint_number_matches & tokenizer.is_ping & tokenizer.ready_for_response
-        data_response_requested  = targeting_endpoint & tokenizer.is_out & interface.rx_ready_for_response
+        data_response_requested  = targeting_endpoint & interface.rx_ready_for_response
 
         okay_to_receive          = targeting_endpoint & sufficient_space & expected_pid_match
         should_skip              = targeting_endpoint & ~expected_pid_match
@@ -199,28 +220,12 @@ class USBStreamOutEndpoint(Elaboratable):
             # "short packet detected" signal, as this indicates that we're detecting the last byte of a transfer.
             fifo.write_data[0:8] .eq(rx.payload),
             fifo.write_data[8]   .eq(rx_last),
-            fifo.write_data[9]   .eq(rx_first),
             fifo.write_en        .eq(okay_to_receive & rx.next & rx.valid),
 
             # We'll keep data if our packet finishes with a valid CRC; and discard it otherwise.
             fifo.write_commit    .eq(targeting_endpoint & boundary_detector.complete_out),
             fifo.write_discard   .eq(targeting_endpoint & boundary_detector.invalid_out),
 
-            # We'll ACK each packet if it's received correctly; _or_ if we skipped the packet
-            # due to a PID sequence mismatch. If we get a PID sequence mismatch, we assume that
-            # we missed a previous ACK from the host; and ACK without accepting data [USB 2.0: 8.6.3].
-            interface.handshakes_out.ack  .eq(
-                (data_response_requested & okay_to_receive) |
-                (ping_response_requested & okay_to_receive) |
-                (data_response_requested & should_skip)
-            ),
-
-            # We'll NAK any time we want to accept a packet, but we don't have enough room.
-            interface.handshakes_out.nak  .eq(
-                (data_response_requested & ~okay_to_receive & ~should_skip) |
-                (ping_response_requested & ~okay_to_receive)
-            ),
-
             # Our stream data always comes directly out of the FIFO; and is valid
             # henever our FIFO actually has data for us to read.
             stream.valid      .eq(~fifo.empty),
@@ -229,16 +234,192 @@ class USBStreamOutEndpoint(Elaboratable):
             # Our `last` bit comes directly from the FIFO; and we know a `first` bit immediately
             # follows a `last` one.
             stream.last       .eq(fifo.read_data[8]),
-            stream.first      .eq(fifo.read_data[9]),
+            stream.first      .eq(is_first_byte),
 
             # Move to the next byte in the FIFO whenever our stream is advaced.
             fifo.read_en      .eq(stream.ready),
             fifo.read_commit  .eq(1)
         ]
 
+        #
+        # Handshake generation.
+        #
+        # We'll ACK each packet if it's received correctly; _or_ if we skipped the packet
+        # due to a PID sequence mismatch. If we get a PID sequence mismatch, we assume that
+        # we missed a previous ACK from the host; and ACK without accepting data [USB 2.0: 8.6.3].
+        #
+        # We'll NAK any time we want to accept a packet, but we don't have enough room.
+        #
+        # We express both of these as a single truth table over our response conditions:
+        #
+        #   should_skip | okay_to_receive | ping_requested | data_requested || response
+        #   ------------|-----------------|----------------|----------------||---------
+        #        -      |        1        |       -        |       1        ||   ACK
+        #        -      |        1        |       1        |       -        ||   ACK
+        #        1      |        -        |       -        |       1        ||   ACK
+        #        0      |        0        |       -        |       1        ||   NAK
+        #        -      |        0        |       1        |       -        ||   NAK
+        #
+        response_conditions = Cat(data_response_requested, ping_response_requested, okay_to_receive, should_skip)
+        m.d.comb += [
+            interface.handshakes_out.ack  .eq(response_conditions.matches("-1-1", "-11-", "1--1")),
+            interface.handshakes_out.nak  .eq(response_conditions.matches("00-1", "-01-")),
+        ]
+
         # We'll toggle our DATA PID each time we issue an ACK to the host [USB 2.0: 8.6.2].
         with m.If(data_response_requested & okay_to_receive):
             m.d.usb += expected_data_toggle.eq(~expected_data_toggle)
 
 
         return m
+
+
+
+class USBStreamInEndpointTest(LunaUSBGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBStreamInEndpoint
+    FRAGMENT_ARGUMENTS  = {'endpoint_number': 1, 'max_packet_size': 8}
+
+    def initialize_signals(self):
+
+        # Pretend that our host is always targeting our endpoint with IN tokens...
+        yield self.dut.interface.tokenizer.endpoint.eq(1)
+        yield self.dut.interface.tokenizer.is_in.eq(1)
+
+        # ... and that our transmitter is always accepting data.
+        yield self.dut.interface.tx.ready.eq(1)
+
+
+    def send_full_packet_transfer(self):
+        """ Sends a stream packet that ends exactly on a max-packet-size boundary; and reads it back out. """
+        dut = self.dut
+        data = [0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x77, 0x88]
+
+        # Send a stream packet that exactly fills one USB packet...
+        yield dut.stream.valid.eq(1)
+        for index, value in enumerate(data):
+            yield dut.stream.payload.eq(value)
+            yield dut.stream.last.eq(index == len(data) - 1)
+            yield
+        yield dut.stream.last.eq(0)
+        yield dut.stream.valid.eq(0)
+
+        # ... and check that we transmit it in response to an IN token.
+        yield from self.pulse(dut.interface.tokenizer.ready_for_response)
+        for value in data:
+            self.assertEqual((yield dut.interface.tx.payload), value)
+            yield
+        yield from self.pulse(dut.interface.handshakes_in.ack)
+
+
+    @usb_domain_test_case
+    def test_zlp_generation(self):
+        dut = self.dut
+        yield from self.send_full_packet_transfer()
+
+        # By default, the next IN token should be answered by a ZLP.
+        yield from self.pulse(dut.interface.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.interface.tx.valid), 1)
+        self.assertEqual((yield dut.interface.tx.last), 1)
+        self.assertEqual((yield dut.interface.handshakes_out.nak), 0)
+
+
+
+class USBStreamInEndpointWithoutZLPsTest(USBStreamInEndpointTest):
+    FRAGMENT_ARGUMENTS  = {'endpoint_number': 1, 'max_packet_size': 8, 'generate_zlps': False}
+
+    @usb_domain_test_case
+    def test_zlp_generation(self):
+        dut = self.dut
+        yield from self.send_full_packet_transfer()
+
+        # With ZLP generation disabled, we have nothing further to send; so the next IN token should be NAK'd.
+        yield from self.pulse(dut.interface.tokenizer.ready_for_response, step_after=False)
+        self.assertEqual((yield dut.interface.tx.valid), 0)
+        self.assertEqual((yield dut.interface.handshakes_out.nak), 1)
+
+
+
+class USBStreamOutEndpointTest(LunaUSBGatewareTestCase):
+    FRAGMENT_UNDER_TEST = USBStreamOutEndpoint
+    FRAGMENT_ARGUMENTS  = {'endpoint_number': 1, 'max_packet_size': 8, 'buffer_size': 16}
+
+    def initialize_signals(self):
+
+        # Pretend that our host is always targeting our endpoint with OUT tokens.
+        yield self.dut.interface.tokenizer.endpoint.eq(1)
+        yield self.dut.interface.tokenizer.is_out.eq(1)
+
+
+    def send_packet(self, data, *, pid_toggle):
+        """ Sends an OUT packet to our endpoint; and returns the handshake it generated, as ``(ack, nak)``. """
+        interface = self.dut.interface
+
+        # Issue our OUT token...
+        yield interface.rx_pid_toggle.eq(pid_toggle)
+        yield from self.pulse(interface.tokenizer.new_token)
+        yield from self.advance_cycles(2)
+
+        # ... send our data...
+        yield interface.rx.valid.eq(1)
+        for byte in data:
+            yield interface.rx.payload.eq(byte)
+            yield interface.rx.next.eq(1)
+            yield
+        yield interface.rx.next.eq(0)
+        yield interface.rx.valid.eq(0)
+        yield from self.pulse(interface.rx_complete)
+
+        # ... and see how our endpoint responds, once the host is ready for a response.
+        yield from self.advance_cycles(5)
+        yield interface.rx_ready_for_response.eq(1)
+        yield
+        handshake = ((yield interface.handshakes_out.ack), (yield interface.handshakes_out.nak))
+        yield interface.rx_ready_for_response.eq(0)
+        yield
+
+        return handshake
+
+
+    def drain_stream(self):
+        """ Reads every byte currently available on our stream; returning a list of ``(payload, first, last)``. """
+        stream = self.dut.stream
+        received = []
+
+        yield stream.ready.eq(1)
+        yield
+
+        while (yield stream.valid):
+            received.append(((yield stream.payload), (yield stream.first), (yield stream.last)))
+            yield
+
+        yield stream.ready.eq(0)
+        return received
+
+
+    @usb_domain_test_case
+    def test_nak_and_retry(self):
+
+        # A full packet, followed by a packet that only just fits in our buffer, should both be accepted...
+        self.assertEqual((yield from self.send_packet([0x10] * 8, pid_toggle=0)), (1, 0))
+        self.assertEqual((yield from self.send_packet([0x20, 0x21, 0x22], pid_toggle=1)), (1, 0))
+
+        # ... but once we no longer have room for a full packet, our next packet should be NAK'd.
+        retried_packet = [0x30, 0x31, 0x32]
+        self.assertEqual((yield from self.send_packet(retried_packet, pid_toggle=0)), (0, 1))
+
+        # Once our consumer drains our buffer, the host's retry of that packet should be accepted.
+        received = yield from self.drain_stream()
+        self.assertEqual((yield from self.send_packet(retried_packet, pid_toggle=0)), (1, 0))
+        received += yield from self.drain_stream()
+
+        # Each packet should have arrived exactly once; with correct framing.
+        expected = []
+        for packet in ([0x10] * 8, [0x20, 0x21, 0x22], retried_packet):
+            for index, byte in enumerate(packet):
+                expected.append((byte, int(index == 0), int(index == len(packet) - 1)))
+
+        self.assertEqual(received, expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -14,13 +14,59 @@ limits what we can do cleanly.
 For an example, see ``examples/usb/eptri``.
 """
 
-from nmigen             import Elaboratable, Module, Array, Signal
+import unittest
+
+from nmigen             import Elaboratable, Module, Signal, Cat, Mux
 from nmigen.lib.fifo    import SyncFIFOBuffered
 from nmigen.hdl.xfrm    import ResetInserter, DomainRenamer
 
 
 from ..endpoint         import EndpointInterface
 from ....soc.peripheral import Peripheral
+from ....test           import LunaUSBGatewareTestCase, usb_domain_test_case
+
+
+def _epno_width(num_endpoints):
+    """ Returns the width of an `epno` register capable of addressing `num_endpoints` endpoints. """
+
+    # USB endpoint numbers are four bits wide; so we can only ever address sixteen endpoints.
+    if not 1 <= num_endpoints <= 16:
+        raise ValueError(f"num_endpoints must be between 1 and 16, not {num_endpoints}")
+
+    return max(1, (num_endpoints - 1).bit_length())
+
+
+def _rx_fifo_connections(fifo, *, allow_write, rx, data, have):
+    """ Generates the connections between a receive FIFO, our receive stream, and its CPU registers.
+
+    Parameters
+    ----------
+    fifo: SyncFIFOBuffered
+        The FIFO that will capture received data.
+    allow_write: Value
+        Condition under which received data should be written into the FIFO.
+    rx: USBOutStreamInterface
+        The stream carrying data received from the host.
+    data: csr.Element
+        The CPU register used to read data out of the FIFO.
+    have: csr.Element
+        The CPU register that indicates whether the FIFO has data available.
+    """
+
+    return [
+
+        # We'll write received data into our FIFO whenever we're allowed to...
+        fifo.w_en      .eq(allow_write & rx.valid & rx.next),
+        fifo.w_data    .eq(rx.payload),
+
+        # ... advance the FIFO whenever our CPU reads from the data CSR;
+        # and we'll always read our data from the FIFO.
+        fifo.r_en      .eq(data.r_stb),
+        data.r_data    .eq(fifo.r_data),
+
+        # Pass the FIFO status on to our CPU.
+        have.r_data    .eq(fifo.r_rdy),
+    ]
 
 
 class SetupFIFOInterface(Peripheral, Elaboratable):
@@ -99,22 +145,15 @@ class SetupFIFOInterface(Peripheral, Elaboratable):
         #
         # Core FIFO.
         #
-        m.submodules.fifo = fifo = ResetInserter(new_setup)(SyncFIFOBuffered(width=8, depth=10))
+        # The data stage of a SETUP transaction is always exactly eight bytes [USB2.0: 9.3]; and our FIFO
+        # is cleared on each new SETUP token, so we only ever need room for a single SETUP packet.
+        m.submodules.fifo = fifo = ResetInserter(new_setup)(SyncFIFOBuffered(width=8, depth=8))
 
         m.d.comb += [
 
             # We'll write to the active FIFO whenever the last received token is a SETUP
-            # token, and we have incoming data; and we'll always write the data received
-            fifo.w_en         .eq(token.is_setup & rx.valid & rx.next),
-            fifo.w_data       .eq(rx.payload),
-
-            # We'll advance the FIFO whenever our CPU reads from the data CSR;
-            # and we'll always read our data from the FIFO.
-            fifo.r_en         .eq(self.data.r_stb),
-            self.data.r_data  .eq(fifo.r_data),
-
-            # Pass the FIFO status on to our CPU.
-            self.have.r_data  .eq(fifo.r_rdy),
+            # token, and we have incoming data.
+            *_rx_fifo_connections(fifo, allow_write=token.is_setup, rx=rx, data=self.data, have=self.have),
 
             # Always acknowledge SETUP packets as they arrive.
             handshakes_out.ack  .eq(token.is_setup & interface.rx_ready_for_response)
@@ -164,18 +203,23 @@ class InFIFOInterface(Peripheral, Elaboratable):
     """
 
 
-    def __init__(self, max_packet_size=64):
+    def __init__(self, max_packet_size=64, num_endpoints=16):
         """
         Parameters
         ----------
             max_packet_size: int, optional
                 Sets the maximum packet size that can be transmitted on this endpoint.
                 This should match the value provided in the relevant endpoint descriptor.
+            num_endpoints: int, optional
+                The number of endpoints this interface needs to address; from 1 to 16. Tokens targeting
+                endpoints numbered `num_endpoints` or higher are never matched; and are always NAK'd.
         """
 
         super().__init__()
 
         self.max_packet_size = max_packet_size
+        self._num_endpoints  = num_endpoints
+        self._epno_width     = _epno_width(num_endpoints)
 
         #
         # Registers
@@ -189,7 +233,7 @@ class InFIFOInterface(Peripheral, Elaboratable):
             it is the software's responsibility to handle breaking requests down into packets.
         """)
 
-        self.epno = regs.csr(4, "rw", desc="""
+        self.epno = regs.csr(self._epno_width, "rw", desc="""
             Contains the endpoint the enqueued packet is to be transmitted on. Writing this register
             marks the relevant packet as ready to transmit; and thus should only be written after a
             full packet has been written into the FIFO. If no data has been placed into the DATA FIFO,
@@ -256,21 +300,22 @@ class InFIFOInterface(Peripheral, Elaboratable):
             fifo.w_data       .eq(self.data.w_data),
         ]
 
-        # Keep track of the amount of data in our FIFO.
-        bytes_in_fifo = Signal(range(0, self.max_packet_size + 1))
-
-        # If we're clearing the whole FIFO, reset our data count.
-        with m.If(self.reset.w_stb):
-            m.d.usb += bytes_in_fifo.eq(0)
+        # Keep track of whether our FIFO holds exactly one byte -- the last byte of our packet.
+        # We compute this a cycle in advance from the FIFO's upcoming level, so the result comes directly
+        # from a register, rather than from a comparator on our transmit path.
+        last_packet = Signal()
 
-        # Keep track of our FIFO's data count as data is added or removed.
-        increment = fifo.w_en & fifo.w_rdy
-        decrement = fifo.r_en & fifo.r_rdy
+        fifo_write = fifo.w_en & fifo.w_rdy
+        fifo_read  = fifo.r_en & fifo.r_rdy
 
-        with m.Elif(increment & ~decrement):
-            m.d.usb += bytes_in_fifo.eq(bytes_in_fifo + 1)
-        with m.Elif(decrement & ~increment):
-            m.d.usb += bytes_in_fifo.eq(bytes_in_fifo - 1)
+        with m.If(self.reset.w_stb):
+            m.d.usb += last_packet.eq(0)
+        with m.Elif(fifo_write & ~fifo_read):
+            m.d.usb += last_packet.eq(fifo.level == 0)
+        with m.Elif(fifo_read & ~fifo_write):
+            m.d.usb += last_packet.eq(fifo.level == 2)
+        with m.Else():
+            m.d.usb += last_packet.eq(fifo.level == 1)
 
 
         #
@@ -281,16 +326,19 @@ class InFIFOInterface(Peripheral, Elaboratable):
         with m.If(self.epno.w_stb):
             m.d.usb += self.epno.r_data.eq(self.epno.w_data)
 
-        # Keep track of which endpoints are stalled.
-        endpoint_stalled = Array(Signal() for _ in range(16))
+        # Keep track of which endpoints are stalled; with one bit per endpoint our `epno` register can address.
+        # Tokens for endpoints beyond the range we support can never be stalled.
+        endpoint_stalled = Signal(2 ** self._epno_width)
+        token_in_range   = (token.endpoint < self._num_endpoints)
+        token_stalled    = endpoint_stalled.bit_select(token.endpoint[:self._epno_width], 1)
 
         # Set the value of our endpoint `stall` based on our `stall` register...
         with m.If(self.stall.w_stb):
-            m.d.usb += endpoint_stalled[self.epno.r_data].eq(self.stall.w_data)
+            m.d.usb += endpoint_stalled.bit_select(self.epno.r_data, 1).eq(self.stall.w_data)
 
         # ... but clear our endpoint `stall` when we get a SETUP packet.
-        with m.If(token.is_setup & token.new_token):
-            m.d.usb += endpoint_stalled[token.endpoint].eq(0)
+        with m.If(token.is_setup & token.new_token & token_in_range):
+            m.d.usb += token_stalled.eq(0)
 
         # Manual data toggle control.
         # TODO: Remove this in favor of automated tracking?
@@ -312,30 +360,40 @@ class InFIFOInterface(Peripheral, Elaboratable):
 
         # Logic shorthand.
         new_in_token     = (token.is_in & token.ready_for_response)
-        endpoint_matches = (token.endpoint == self.epno.r_data)
-        stalled          = endpoint_stalled[token.endpoint]
+
+        # We'll register our endpoint comparisons, which keeps them off the path into our FSM and handshakes.
+        # This adds a cycle of latency. For tokens, this is never visible: we only respond to an IN token once it's
+        # ready for a response, an interpacket delay after it arrives. It does, however, delay the effects of CPU
+        # writes: an IN token that's ready for a response within a cycle of an `epno` write is still compared against
+        # our old endpoint number, and one that's ready within two cycles of a `stall` write sees our old stall state.
+        # The registered stall state also decides whether an `epno` write primes our endpoint.
+        endpoint_matches = Signal()
+        stalled          = Signal()
+        m.d.usb += [
+            endpoint_matches  .eq(token_in_range & (token.endpoint == self.epno.r_data)),
+            stalled           .eq(token_in_range & token_stalled),
+        ]
 
         with m.FSM(domain='usb') as f:
 
+            idle   = f.ongoing('IDLE')
+            primed = f.ongoing('PRIMED')
+
             # Drive our IDLE line based on our FSM state.
-            m.d.comb += self.idle.r_data.eq(f.ongoing('IDLE'))
+            m.d.comb += self.idle.r_data.eq(idle)
+
+            # Whenever we're not sending data, we'll reply to IN tokens with a handshake:
+            # - If the target endpoint is STALL'd, we'll reply with STALL no matter what.
+            # - Otherwise, we'll NAK any token we don't have a response for.
+            m.d.comb += [
+                handshakes_out.stall  .eq(new_in_token & (idle | primed) & stalled),
+                handshakes_out.nak    .eq(new_in_token & (idle | (primed & ~endpoint_matches)) & ~stalled),
+            ]
 
             # IDLE -- our CPU hasn't yet requested that we send data.
             # We'll wait for it to do so, and NAK any packets that arrive.
             with m.State("IDLE"):
 
-                # If we get an IN token...
-                with m.If(new_in_token):
-
-                    # STALL it, if the endpoint is STALL'd...
-                    with m.If(stalled):
-                        m.d.comb += handshakes_out.stall.eq(1)
-
-                    # Otherwise, NAK.
-                    with m.Else():
-                        m.d.comb += handshakes_out.nak.eq(1)
-
-
                 # If the user request that we send data, "prime" the endpoint.
                 # This means we have data to send, but are just waiting for an IN token.
                 with m.If(self.epno.w_stb & ~stalled):
@@ -345,27 +403,17 @@ class InFIFOInterface(Peripheral, Elaboratable):
             # Await that IN token.
             with m.State("PRIMED"):
 
-                with m.If(new_in_token):
-
-                    # If the target endpoint is STALL'd, reply with STALL no matter what.
-                    with m.If(stalled):
-                        m.d.comb += handshakes_out.stall.eq(1)
-
-                    # If we have a new IN token to our endpoint, move to responding to it.
-                    with m.Elif(endpoint_matches):
+                # If we have a new IN token to our endpoint, move to responding to it.
+                with m.If(new_in_token & ~stalled & endpoint_matches):
 
-                        # If there's no data in our endpoint, send a ZLP.
-                        with m.If(~fifo.r_rdy):
-                            m.next = "SEND_ZLP"
+                    # If there's no data in our endpoint, send a ZLP.
+                    with m.If(~fifo.r_rdy):
+                        m.next = "SEND_ZLP"
 
-                        # Otherwise, send our data, starting with our first byte.
-                        with m.Else():
-                            m.d.usb += tx.first.eq(1)
-                            m.next = "SEND_DATA"
-
-                    # Otherwise, we don't have a response; NAK the packet.
+                    # Otherwise, send our data, starting with our first byte.
                     with m.Else():
-                        m.d.comb += handshakes_out.nak.eq(1)
+                        m.d.usb += tx.first.eq(1)
+                        m.next = "SEND_DATA"
 
             # SEND_ZLP -- we're now now ready to respond to an IN token with a ZLP.
             # Send our response.
@@ -379,8 +427,6 @@ class InFIFOInterface(Peripheral, Elaboratable):
             # SEND_DATA -- we're now ready to respond to an IN token to our endpoint.
             # Send our response.
             with m.State("SEND_DATA"):
-                last_packet = (bytes_in_fifo == 1)
-
                 m.d.comb += [
                     tx.valid    .eq(1),
                     tx.last     .eq(last_packet),
@@ -416,9 +462,20 @@ class OutFIFOInterface(Peripheral, Elaboratable):
         Our primary interface to the core USB device hardware.
     """
 
-    def __init__(self):
+    def __init__(self, num_endpoints=16):
+        """
+        Parameters
+        ----------
+            num_endpoints: int, optional
+                The number of endpoints this interface needs to address; from 1 to 16. Tokens targeting
+                endpoints numbered `num_endpoints` or higher are never matched; and are always NAK'd.
+        """
+
         super().__init__()
 
+        self._num_endpoints = num_endpoints
+        self._epno_width    = _epno_width(num_endpoints)
+
         #
         # Registers
         #
@@ -433,7 +490,7 @@ class OutFIFOInterface(Peripheral, Elaboratable):
             Local reset for the OUT handler; clears the out FIFO.
         """)
 
-        self.epno = regs.csr(4, "rw", desc="""
+        self.epno = regs.csr(self._epno_width, "rw", desc="""
             Selects the endpoint number to prime. This interface only allows priming a single endpoint at once--
             that is, only one endpoint can be ready to receive data at a time. See the `enable` bit for usage.
         """)
@@ -498,8 +555,11 @@ class OutFIFOInterface(Peripheral, Elaboratable):
         with m.If(self.epno.w_stb):
             m.d.usb += self.epno.r_data.eq(self.epno.w_data)
 
-        # Keep track of which endpoints are stalled.
-        endpoint_stalled = Array(Signal() for _ in range(16))
+        # Keep track of which endpoints are stalled; with one bit per endpoint our `epno` register can address.
+        # Tokens for endpoints beyond the range we support can never be stalled.
+        endpoint_stalled = Signal(2 ** self._epno_width)
+        token_in_range   = (token.endpoint < self._num_endpoints)
+        token_stalled    = endpoint_stalled.bit_select(token.endpoint[:self._epno_width], 1)
 
         # Allow the CPU to set our enable bit.
         with m.If(self.enable.w_stb):
@@ -512,11 +572,11 @@ class OutFIFOInterface(Peripheral, Elaboratable):
 
         # Set the value of our endpoint `stall` based on our `stall` register...
         with m.If(self.stall.w_stb):
-            m.d.usb += endpoint_stalled[self.epno.r_data].eq(self.stall.w_data)
+            m.d.usb += endpoint_stalled.bit_select(self.epno.r_data, 1).eq(self.stall.w_data)
 
         # ... but clear our endpoint `stall` when we get a SETUP packet.
-        with m.If(token.is_setup & token.new_token):
-            m.d.usb += endpoint_stalled[token.endpoint].eq(0)
+        with m.If(token.is_setup & token.new_token & token_in_range):
+            m.d.usb += token_stalled.eq(0)
 
         #
         # Core FIFO.
@@ -528,33 +588,23 @@ class OutFIFOInterface(Peripheral, Elaboratable):
         #  - We've primed the relevant endpoint.
         #  - Our most recent token is an OUT.
         #  - We're not stalled.
-        stalled          = token.is_out & endpoint_stalled[token.endpoint]
-        endpoint_matches = (token.endpoint == self.epno.r_data)
+        stalled          = token.is_out & token_in_range & token_stalled
+        endpoint_matches = token_in_range & (token.endpoint == self.epno.r_data)
         allow_receive    = endpoint_matches & self.enable.r_data & token.is_out & ~stalled
         nak_receives     = token.is_out & ~allow_receive & ~stalled
 
         m.d.comb += [
 
-            # We'll write to the endpoint iff we have a primed
-            fifo.w_en         .eq(allow_receive & rx.valid & rx.next),
-            fifo.w_data       .eq(rx.payload),
-
-            # We'll advance the FIFO whenever our CPU reads from the data CSR;
-            # and we'll always read our data from the FIFO.
-            fifo.r_en         .eq(self.data.r_stb),
-            self.data.r_data  .eq(fifo.r_data),
-
-            # Pass the FIFO status on to our CPU.
-            self.have.r_data  .eq(fifo.r_rdy),
-
-            # If we've just finished an allowed receive, ACK.
-            handshakes_out.ack    .eq(allow_receive & interface.rx_ready_for_response),
-
-            # If we were stalled, stall.
-            handshakes_out.stall  .eq(stalled & interface.rx_ready_for_response),
+            # We'll write to the endpoint iff we have a primed receive; and connect our FIFO to our CPU.
+            *_rx_fifo_connections(fifo, allow_write=allow_receive, rx=rx, data=self.data, have=self.have),
 
-            # If we're not ACK'ing or STALL'ing, NAK all packets.
-            handshakes_out.nak    .eq(nak_receives & interface.rx_ready_for_response)
+            # Once the host is ready for a response, we'll issue exactly one of our handshakes:
+            # - If we've just finished an allowed receive, ACK.
+            # - If we were stalled, stall.
+            # - If we're not ACK'ing or STALL'ing, NAK all packets.
+            Cat(handshakes_out.ack, handshakes_out.stall, handshakes_out.nak).eq(
+                Mux(interface.rx_ready_for_response, Cat(allow_receive, stalled, nak_receives), 0)
+            )
         ]
 
 
@@ -563,3 +613,150 @@ class OutFIFOInterface(Peripheral, Elaboratable):
         #
 
         return DomainRenamer({"sync": "usb"})(m)
+
+
+
+class InFIFOInterfaceTest(LunaUSBGatewareTestCase):
+    FRAGMENT_UNDER_TEST = InFIFOInterface
+    FRAGMENT_ARGUMENTS  = {'num_endpoints': 3}
+
+    def write_register(self, register, value):
+        """ Performs a CPU write to one of our CSRs. """
+        yield register.w_data.eq(value)
+        yield from self.pulse(register.w_stb)
+
+
+    def issue_in_token(self, endpoint):
+        """ Issues an IN token to the given endpoint; and returns our response, as ``(nak, stall, tx_valid)``. """
+        tokenizer = self.dut.interface.tokenizer
+
+        yield tokenizer.endpoint.eq(endpoint)
+        yield tokenizer.is_in.eq(1)
+        yield from self.advance_cycles(2)
+
+        yield tokenizer.ready_for_response.eq(1)
+        yield
+        handshakes = self.dut.interface.handshakes_out
+        nak, stall = (yield handshakes.nak), (yield handshakes.stall)
+        yield tokenizer.ready_for_response.eq(0)
+        yield tokenizer.is_in.eq(0)
+
+        # If we've accepted the token, we'll start transmitting on the following cycle.
+        yield
+        tx_valid = (yield self.dut.interface.tx.valid)
+        yield
+
+        return (nak, stall, tx_valid)
+
+
+    def issue_setup_token(self, endpoint):
+        """ Issues a SETUP token to the given endpoint. """
+        tokenizer = self.dut.interface.tokenizer
+
+        yield tokenizer.endpoint.eq(endpoint)
+        yield tokenizer.is_setup.eq(1)
+        yield from self.pulse(tokenizer.new_token)
+        yield tokenizer.is_setup.eq(0)
+
+
+    @usb_domain_test_case
+    def test_endpoint_range(self):
+        dut = self.dut
+
+        # If we prime an endpoint beyond our supported range -- and even try to stall it --
+        # any IN tokens to that endpoint should still be NAK'd.
+        yield from self.write_register(dut.epno, 3)
+        yield from self.write_register(dut.stall, 1)
+        self.assertEqual((yield from self.issue_in_token(3)), (1, 0, 0))
+
+        # Endpoints within our range should STALL normally...
+        yield from self.write_register(dut.epno, 2)
+        yield from self.write_register(dut.stall, 1)
+        self.assertEqual((yield from self.issue_in_token(2)), (0, 1, 0))
+
+        # ... until a SETUP token clears their stall; after which our primed ZLP should be sent.
+        yield from self.issue_setup_token(2)
+        self.assertEqual((yield from self.issue_in_token(2)), (0, 0, 1))
+
+
+    def test_invalid_endpoint_counts(self):
+        for num_endpoints in (0, 17):
+            with self.assertRaises(ValueError):
+                InFIFOInterface(num_endpoints=num_endpoints)
+
+
+
+class OutFIFOInterfaceTest(LunaUSBGatewareTestCase):
+    FRAGMENT_UNDER_TEST = OutFIFOInterface
+    FRAGMENT_ARGUMENTS  = {'num_endpoints': 3}
+
+    def initialize_signals(self):
+
+        # Pretend that our host is always issuing OUT tokens.
+        yield self.dut.interface.tokenizer.is_out.eq(1)
+
+
+    def write_register(self, register, value):
+        """ Performs a CPU write to one of our CSRs. """
+        yield register.w_data.eq(value)
+        yield from self.pulse(register.w_stb)
+
+
+    def issue_out_token(self, endpoint):
+        """ Issues an OUT token to the given endpoint; and returns our response, as ``(ack, nak, stall)``. """
+        interface = self.dut.interface
+
+        yield interface.tokenizer.endpoint.eq(endpoint)
+        yield interface.rx_ready_for_response.eq(1)
+        yield
+        handshakes = interface.handshakes_out
+        response = ((yield handshakes.ack), (yield handshakes.nak), (yield handshakes.stall))
+        yield interface.rx_ready_for_response.eq(0)
+        yield
+
+        return response
+
+
+    def issue_setup_token(self, endpoint):
+        """ Issues a SETUP token to the given endpoint. """
+        tokenizer = self.dut.interface.tokenizer
+
+        yield tokenizer.endpoint.eq(endpoint)
+        yield tokenizer.is_out.eq(0)
+        yield tokenizer.is_setup.eq(1)
+        yield from self.pulse(tokenizer.new_token)
+        yield tokenizer.is_setup.eq(0)
+        yield tokenizer.is_out.eq(1)
+
+
+    @usb_domain_test_case
+    def test_endpoint_range(self):
+        dut = self.dut
+
+        # If we prime an endpoint beyond our supported range, any OUT tokens to it should be NAK'd...
+        yield from self.write_register(dut.epno, 3)
+        yield from self.write_register(dut.enable, 1)
+        self.assertEqual((yield from self.issue_out_token(3)), (0, 1, 0))
+
+        # ... even if we've tried to stall it.
+        yield from self.write_register(dut.stall, 1)
+        self.assertEqual((yield from self.issue_out_token(3)), (0, 1, 0))
+
+        # Endpoints within our range should STALL normally...
+        yield from self.write_register(dut.epno, 2)
+        yield from self.write_register(dut.stall, 1)
+        self.assertEqual((yield from self.issue_out_token(2)), (0, 0, 1))
+
+        # ... until a SETUP token clears their stall; after which they can receive data again.
+        yield from self.issue_setup_token(2)
+        self.assertEqual((yield from self.issue_out_token(2)), (1, 0, 0))
+
+
+    def test_invalid_endpoint_counts(self):
+        for num_endpoints in (0, 17):
+            with self.assertRaises(ValueError):
+                OutFIFOInterface(num_endpoints=num_endpoints)
+
+
+if __name__ == "__main__":
+    unittest.main()